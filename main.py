@@ -1,17 +1,308 @@
+import os
+# Must be set before torch initializes CUDA. Expandable segments keep the
+# caching allocator from fragmenting across the differently sized tensors of
+# each pipeline stage.
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 import cv2
-from flask import Flask, Response, render_template_string
+from jinja2 import Template
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+import uvicorn
+import asyncio
+import contextlib
 import threading
 from ultralytics import YOLO
+from ultralytics.nn.autobackend import AutoBackend
+try:
+    # Newer Ultralytics releases moved NMS out of ultralytics.utils.ops.
+    from ultralytics.utils.nms import non_max_suppression
+except ImportError:
+    from ultralytics.utils.ops import non_max_suppression
+import torch
+import torchvision
+from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
 import time
-import json
+import orjson
+import xxhash
+import queue
+import numpy as np
+from fractions import Fraction
+
+try:
+    # Optional; without it the page falls back to the MJPEG stream.
+    import av
+    from aiortc import MediaStreamTrack, RTCPeerConnection, RTCRtpSender, RTCSessionDescription
+except ImportError:
+    av = None
+USE_WEBRTC = av is not None
+
+# Camera indices to stream from. None probes the usual indices and backends
+# for a single camera; list several indices to run multiple cameras at once.
+CAMERA_SOURCES = [None]
+FRAME_WIDTH = 640
+FRAME_HEIGHT = 480
+# Nominal frame rate of the cameras; most UVC webcams deliver 30 fps at 640x480.
+CAMERA_FPS = 30
+# /video_feed?res=small streams a downscaled preview for small embedded UIs.
+# Detection still runs at full resolution.
+PREVIEW_SCALE = 0.5
+PREVIEW_WIDTH = int(FRAME_WIDTH * PREVIEW_SCALE)
+PREVIEW_HEIGHT = int(FRAME_HEIGHT * PREVIEW_SCALE)
+MODEL_WEIGHTS = 'yolov8n.pt'
+# Frames from all cameras share one forward pass, so the engine is built for
+# up to one frame per camera.
+BATCH_SIZE = len(CAMERA_SOURCES)
+# 'fp16' or 'int8'. INT8 needs CALIBRATION_DATA: an Ultralytics dataset YAML
+# pointing at 100-300 frames recorded from the deployed camera, which TensorRT
+# uses for entropy calibration when the engine is built.
+ENGINE_PRECISION = 'fp16'
+CALIBRATION_DATA = 'calib.yaml'
+ENGINE_PATH = f'yolov8n-{ENGINE_PRECISION}-b{BATCH_SIZE}.engine'
+# How long the inference stage waits for new frames when none are queued.
+BATCH_INTERVAL = 0.005
+JPEG_QUALITY = 85
+# An MJPEG client is not re-sent a JPEG identical to the last one it got,
+# except once per JPEG_REFRESH_INTERVAL seconds to keep the connection alive.
+JPEG_REFRESH_INTERVAL = 1.0
+# WebRTC video is encoded once per camera and shared by every client. NVENC is
+# tried first; libx264 is the fallback on hosts without an NVIDIA encoder.
+# Baseline profile without B-frames keeps browsers and latency happy. NVENC
+# needs forced-idr for a forced keyframe to be an IDR frame with SPS/PPS that
+# a joining peer can start decoding from.
+H264_ENCODERS = [
+    ('h264_nvenc', {'preset': 'llhp', 'zerolatency': '1', 'profile': 'baseline', 'forced-idr': '1'}),
+    ('libx264', {'preset': 'ultrafast', 'tune': 'zerolatency', 'profile': 'baseline'}),
+]
+H264_BITRATE = 2_000_000
+H264_GOP = 15
+H264_TIME_BASE = Fraction(1, 90000)
+# Every H.264 packet must reach a peer for it to decode until the next
+# keyframe, so each peer queues them. A peer that falls this far behind is
+# reset to the next keyframe instead.
+H264_PEER_QUEUE = 30
+# One buffer per place a frame can be held: the capture read, capture_q, the
+# batch being uploaded, the batch being inferred, infer_q and the encode stage.
+FRAME_BUFFERS = 6
+# Frames whose downscaled mean absolute difference from the last inferred frame
+# stays below MOTION_THRESHOLD reuse its detections instead of running YOLO.
+MOTION_SIZE = (80, 60)
+MOTION_THRESHOLD = 2.0
+# Ultralytics' default predict thresholds.
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.7
+
+USE_CUDA = torch.cuda.is_available()
+DEVICE = torch.device('cuda:0' if USE_CUDA else 'cpu')
+
+torch.set_float32_matmul_precision('high')
+# The input shape is fixed, so let cuDNN pick the fastest convolution
+# algorithms once. Only affects the PyTorch weights; TensorRT tunes its own.
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+def load_model():
+    # The TensorRT engine is tied to the GPU and TensorRT version it was built
+    # with, so it is exported on first start and reused afterwards. Frames are
+    # fed to the backend directly, skipping Ultralytics' predictor.
+    if not USE_CUDA:
+        print("Warning: CUDA is not available, running PyTorch weights on CPU.")
+        return AutoBackend(MODEL_WEIGHTS, device=DEVICE, fp16=False)
+
+    if not os.path.exists(ENGINE_PATH):
+        print(f"Info: Exporting {MODEL_WEIGHTS} to TensorRT {ENGINE_PRECISION.upper()} engine {ENGINE_PATH}...")
+        if ENGINE_PRECISION == 'int8':
+            precision_args = {'int8': True, 'data': CALIBRATION_DATA}
+        else:
+            precision_args = {'half': True}
+        # A dynamic batch lets fewer than BATCH_SIZE frames run when some
+        # cameras have nothing new.
+        exported = YOLO(MODEL_WEIGHTS).export(format='engine', imgsz=(FRAME_HEIGHT, FRAME_WIDTH),
+                                              device=DEVICE, batch=BATCH_SIZE,
+                                              dynamic=BATCH_SIZE > 1, **precision_args)
+        os.replace(exported, ENGINE_PATH)
+
+    print(f"Info: Loading TensorRT engine {ENGINE_PATH}.")
+    return AutoBackend(ENGINE_PATH, device=DEVICE, fp16=True)
+
+model = load_model()
+# AutoBackend sets fp16 from the engine's input binding and never casts up to
+# FP32, so the staging dtype has to follow it rather than assume FP16.
+INPUT_DTYPE = torch.float16 if model.fp16 else torch.float32
+
+def preprocess(raw):
+    """BGR NHWC uint8 frames -> contiguous RGB NCHW in INPUT_DTYPE, scaled to 0-1."""
+    # Frames already match the engine's 480x640 input, so no letterboxing or
+    # box rescaling is needed.
+    return (raw[..., [2, 1, 0]].permute(0, 3, 1, 2).float() * (1 / 255.0)).to(INPUT_DTYPE).contiguous()
+
+try:
+    tj = TurboJPEG()
+except (OSError, RuntimeError) as e:
+    # PyTurboJPEG raises RuntimeError when it cannot find libjpeg-turbo or
+    # the installed one is too old for it.
+    print(f"Warning: libjpeg-turbo unavailable ({e}), falling back to cv2.imencode.")
+    tj = None
+
+def nvjpeg_available():
+    # torchvision encodes CUDA tensors with nvJPEG from 0.19 on; older
+    # versions reject non-CPU input.
+    if not USE_CUDA:
+        return False
+    try:
+        torchvision.io.encode_jpeg(torch.zeros((3, 16, 16), dtype=torch.uint8, device=DEVICE))
+    except (RuntimeError, NotImplementedError) as e:
+        print(f"Warning: nvJPEG encoding unavailable ({e}), encoding JPEGs on the CPU.")
+        return False
+    return True
+
+USE_NVJPEG = nvjpeg_available()
+
+def encode_jpeg(img):
+    if USE_NVJPEG:
+        # img is a pinned BGR frame; only the finished JPEG comes back over
+        # PCIe, and .cpu() waits for the upload before img can be reused.
+        rgb = torch.from_numpy(img).to(DEVICE, non_blocking=True)[..., [2, 1, 0]].permute(2, 0, 1).contiguous()
+        return torchvision.io.encode_jpeg(rgb, quality=JPEG_QUALITY).cpu().numpy().tobytes()
+    if tj is not None:
+        return tj.encode(img, quality=JPEG_QUALITY, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+    _, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes()
 
-model = YOLO()
+# Event loop serving HTTP clients; the encode threads hand new frames to it.
+loop = None
 
-app = Flask(__name__)
+class Camera:
+    """Pipeline state for one camera source."""
 
-frame = None
-detections = []
-lock = threading.Lock()
+    def __init__(self, source_id, source):
+        self.source_id = source_id
+        self.source = source
+
+        # Single-slot queues between the capture -> inference -> encode
+        # stages. Each stage only ever wants the newest frame, so a full queue
+        # drops its stale item.
+        self.capture_q = queue.Queue(maxsize=1)
+        self.infer_q = queue.Queue(maxsize=1)
+
+        # Preallocated frame buffers; the camera reads into a free one and the
+        # encode stage hands it back once the JPEG is done, so frames are never
+        # copied. They are pinned so the inference stage can DMA them to the
+        # GPU directly.
+        self.free_buffers = queue.Queue()
+        for _ in range(FRAME_BUFFERS):
+            buf = torch.empty((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=torch.uint8, pin_memory=USE_CUDA)
+            self.free_buffers.put(buf.numpy())
+
+        # Downscaled copy of the last frame YOLO ran on, for the motion check.
+        self.prev_small = None
+
+        # latest_jpeg and detections_json are replaced wholesale, never
+        # mutated, so readers can pick up the current reference without taking
+        # a lock. Detections are serialized once per inferred frame, not once
+        # per HTTP request. JPEGs are stored as (multipart chunk, xxh3 hash).
+        self.latest_jpeg = None
+        self.detections_json = b'[]'
+
+        # Integer boxes and labels of the last detections, drawn by the encoder.
+        self.overlay = (np.empty((0, 4), dtype=int), [])
+
+        # Preview buffer and (multipart chunk, hash) for res=small.
+        self.preview = torch.empty((PREVIEW_HEIGHT, PREVIEW_WIDTH, 3), dtype=torch.uint8, pin_memory=USE_CUDA).numpy()
+        self.latest_preview_jpeg = None
+
+        # H.264 stream shared by all WebRTC clients.
+        self.h264 = H264Stream() if USE_WEBRTC else None
+
+        # One asyncio.Event per streaming client, per video resolution or
+        # detection stream; WebRTC clients are their CameraTracks. The sets are
+        # only modified on the event loop; a stream is only encoded while its
+        # set is non-empty.
+        self.waiters = {'full': set(), 'small': set(), 'webrtc': set(), 'detections': set()}
+
+    def release_frame(self, img):
+        self.free_buffers.put(img)
+
+    def pass_to_encoder(self, img, overlay):
+        put_latest(self.infer_q, (img, overlay), on_drop=lambda item: self.release_frame(item[0]))
+
+    def notify_clients(self, *kinds):
+        """Wakes every streaming client of the given kinds. Must run on the event loop."""
+        for kind in kinds:
+            for event in self.waiters[kind]:
+                event.set()
+
+    def publish_h264(self, packet, is_keyframe):
+        """Queues an H.264 packet for every WebRTC client. Must run on the event loop."""
+        for track in self.waiters['webrtc']:
+            track.push(packet, is_keyframe)
+
+def open_h264_codec():
+    for name, options in H264_ENCODERS:
+        try:
+            codec = av.CodecContext.create(name, 'w')
+            codec.width = FRAME_WIDTH
+            codec.height = FRAME_HEIGHT
+            codec.pix_fmt = 'yuv420p'
+            codec.time_base = H264_TIME_BASE
+            # Otherwise FFmpeg derives the rate from the 90 kHz time base,
+            # which skews rate control and the level choice.
+            codec.framerate = Fraction(CAMERA_FPS)
+            codec.bit_rate = H264_BITRATE
+            codec.gop_size = H264_GOP
+            codec.max_b_frames = 0
+            codec.options = options
+            codec.open()
+        except (av.error.FFmpegError, ValueError) as e:
+            print(f"Info: H.264 encoder {name} unavailable: {e}")
+            continue
+        print(f"Info: Encoding WebRTC video with {name}.")
+        return codec
+    raise RuntimeError("No H.264 encoder available for WebRTC.")
+
+if USE_WEBRTC:
+    # Open an encoder once at startup, so a host without one serves the MJPEG
+    # page instead of killing the encode thread on the first WebRTC client.
+    try:
+        open_h264_codec()
+    except RuntimeError as e:
+        print(f"Warning: {e} Falling back to MJPEG.")
+        USE_WEBRTC = False
+
+class H264Stream:
+    """Encodes one camera's boxed frames to H.264 for all of its WebRTC clients."""
+
+    def __init__(self):
+        self.codec = None
+        self.start = time.monotonic()
+        # Set when a client joins or a slow one resets, so it does not wait
+        # for the next GOP.
+        self.force_keyframe = False
+
+    def encode(self, img):
+        """Returns (packet, is_keyframe) for a BGR frame, or None while the encoder buffers."""
+        if self.codec is None:
+            self.codec = open_h264_codec()
+
+        frame = av.VideoFrame.from_ndarray(cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420), format='yuv420p')
+        frame.pts = int((time.monotonic() - self.start) / H264_TIME_BASE)
+        frame.time_base = H264_TIME_BASE
+        if self.force_keyframe:
+            self.force_keyframe = False
+            frame.pict_type = av.video.frame.PictureType.I
+
+        packets = self.codec.encode(frame)
+        if not packets:
+            return None
+        packet = av.Packet(b''.join(bytes(p) for p in packets))
+        packet.pts = frame.pts
+        packet.time_base = H264_TIME_BASE
+        return packet, any(p.is_keyframe for p in packets)
+
+cameras = [Camera(source_id, source) for source_id, source in enumerate(CAMERA_SOURCES)]
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -57,63 +348,113 @@ HTML_TEMPLATE = """
 </head>
 <body>
     <h1>Object Detection Stream</h1>
+    {% for camera in cameras %}
     <div class="container">
         <div class="video-container">
-            <img src="/video_feed" width="640" height="480">
+            {% if webrtc %}
+            <video id="video-{{ camera.source_id }}" width="640" height="480" autoplay muted playsinline></video>
+            {% else %}
+            <img src="/video_feed?source={{ camera.source_id }}" width="640" height="480">
+            {% endif %}
         </div>
         <div class="info-container">
             <h2>Detection Information</h2>
-            <div id="detections"></div>
+            <div id="detections-{{ camera.source_id }}"></div>
         </div>
     </div>
+    {% endfor %}
 
     <script>
-        // Function to fetch and update detections
-        async function updateDetections() {
-            try {
-                const response = await fetch('/detections');
-                const data = await response.json();
-                
-                const detectionsDiv = document.getElementById('detections');
-                detectionsDiv.innerHTML = '';
-                
-                data.forEach((detection, index) => {
-                    const div = document.createElement('div');
-                    div.className = 'detection-item';
-                    div.innerHTML = `
-                        <strong>${detection.class_name}</strong> (Conf: ${detection.confidence.toFixed(2)})<br>
-                        Box: [${detection.bbox.map(v => Math.round(v)).join(', ')}]<br>
-                        Center: (${Math.round(detection.center_x)}, ${Math.round(detection.center_y)})
-                    `;
-                    detectionsDiv.appendChild(div);
-                });
-            } catch (error) {
-                console.error('Error fetching detections:', error);
-            }
+        // Function to render a camera's detections
+        function renderDetections(sourceId, data) {
+            const detectionsDiv = document.getElementById(`detections-${sourceId}`);
+            detectionsDiv.innerHTML = '';
             
-            // Update every 100ms
-            setTimeout(updateDetections, 100);
+            data.forEach((detection, index) => {
+                const div = document.createElement('div');
+                div.className = 'detection-item';
+                div.innerHTML = `
+                    <strong>${detection.class_name}</strong> (Conf: ${detection.confidence.toFixed(2)})<br>
+                    Box: [${detection.bbox.map(v => Math.round(v)).join(', ')}]<br>
+                    Center: (${Math.round(detection.center_x)}, ${Math.round(detection.center_y)})
+                `;
+                detectionsDiv.appendChild(div);
+            });
         }
         
-        // Start updating detections
-        updateDetections();
+        {% if webrtc %}
+        // Receive the camera as an H.264 WebRTC stream
+        async function startVideo(sourceId) {
+            const pc = new RTCPeerConnection();
+            pc.addTransceiver('video', {direction: 'recvonly'});
+            pc.ontrack = e => {
+                document.getElementById(`video-${sourceId}`).srcObject = new MediaStream([e.track]);
+            };
+            
+            await pc.setLocalDescription(await pc.createOffer());
+            await new Promise(resolve => {
+                if (pc.iceGatheringState === 'complete') {
+                    resolve();
+                } else {
+                    pc.addEventListener('icegatheringstatechange', () => {
+                        if (pc.iceGatheringState === 'complete') resolve();
+                    });
+                }
+            });
+            
+            const response = await fetch(`/offer?source=${sourceId}`, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({sdp: pc.localDescription.sdp, type: pc.localDescription.type})
+            });
+            await pc.setRemoteDescription(await response.json());
+        }
+        
+        {% for camera in cameras %}
+        startVideo({{ camera.source_id }}).catch(error => console.error('Error starting video:', error));
+        {% endfor %}
+        {% endif %}
+        
+        // The server pushes new detections as they are computed
+        {% for camera in cameras %}
+        new EventSource('/detections/stream?source={{ camera.source_id }}').onmessage =
+            e => renderDetections({{ camera.source_id }}, JSON.parse(e.data));
+        {% endfor %}
     </script>
 </body>
 </html>
 """
 
-def capture_video():
-    global frame, detections
-    
+def put_latest(q, item, on_drop=None):
+    """Puts item on a single-slot queue, dropping the stale item if it is full."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                stale = q.get_nowait()
+            except queue.Empty:
+                continue
+            if on_drop is not None:
+                on_drop(stale)
+
+def open_camera(source):
     cap = None
-    camera_indices_to_try = [
-        (0, cv2.CAP_V4L2),
-        (0),
-        (1, cv2.CAP_V4L2),
-        (1),
-        (2),
-        (4)
-    ]
+    if source is None:
+        camera_indices_to_try = [
+            (0, cv2.CAP_V4L2),
+            (0),
+            (1, cv2.CAP_V4L2),
+            (1),
+            (2),
+            (4)
+        ]
+    else:
+        camera_indices_to_try = [
+            (source, cv2.CAP_V4L2),
+            (source)
+        ]
 
     for index_args in camera_indices_to_try:
         if isinstance(index_args, tuple):
@@ -132,11 +473,13 @@ def capture_video():
 
     if not cap or not cap.isOpened():
         print("Error: Could not open any camera after trying multiple indices and backends.")
-        return
+        return None
     
-    print(f"Info: Setting frame width to 640 and height to 480.")
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    print(f"Info: Setting frame width to {FRAME_WIDTH} and height to {FRAME_HEIGHT}.")
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+    # Keep the driver from queueing stale frames behind the one we want.
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
     print("Info: Warming up camera...")
     for _ in range(10):
@@ -147,87 +490,390 @@ def capture_video():
             print("Warning: Failed to read a warm-up frame.")
         time.sleep(0.05)
 
-    print("Info: Camera warm-up complete. Starting main capture loop.")
+    print("Info: Camera warm-up complete.")
+    return cap
+
+def capture_frames(camera):
+    """Stage 1: reads frames from one camera into its capture_q."""
+    cap = open_camera(camera.source)
+    if cap is None:
+        return
 
+    print(f"Info: Starting capture loop for camera {camera.source_id}.")
+    warned_size = False
     while True:
-        ret, img = cap.read()
+        buf = camera.free_buffers.get()
+        ret, img = cap.read(buf)
         if not ret:
-            print("Error: Failed to capture frame. 'ret' is False.")
+            print(f"Error: Failed to capture frame from camera {camera.source_id}. 'ret' is False.")
+            camera.release_frame(buf)
             time.sleep(0.1)
             continue
         
         if img is None:
-            print("Error: Captured frame is None.")
+            print(f"Error: Captured frame from camera {camera.source_id} is None.")
+            camera.release_frame(buf)
             time.sleep(0.1)
             continue
-            
 
-        results = model(img)
-        result = results[0]
-        
-        current_detections = []
-        
-        for box in result.boxes:
-            x1, y1, x2, y2 = box.xyxy[0].tolist()
-            conf = box.conf[0].item()
-            cls = int(box.cls[0].item())
-            class_name = result.names[cls]
-            
-            center_x = (x1 + x2) / 2
-            center_y = (y1 + y2) / 2
-            
-            current_detections.append({
-                'bbox': [x1, y1, x2, y2],
-                'confidence': conf,
-                'class_id': cls,
-                'class_name': class_name,
-                'center_x': center_x,
-                'center_y': center_y
-            })
-            
-            cv2.rectangle(img, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
-            
-            label = f"{class_name}: {conf:.2f}"
-            cv2.putText(img, label, (int(x1), int(y1-10)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-        
-        with lock:
-            frame = img.copy()
-            detections = current_detections
+        # CAP_PROP_FRAME_WIDTH/HEIGHT are only a request. A camera that
+        # ignores them makes OpenCV allocate a new array instead of filling
+        # buf, so scale it into buf: everything downstream assumes the
+        # pooled 480x640 frame.
+        if img.shape != buf.shape:
+            if not warned_size:
+                print(f"Warning: Camera {camera.source_id} delivers {img.shape[1]}x{img.shape[0]} frames, resizing to {FRAME_WIDTH}x{FRAME_HEIGHT}.")
+                warned_size = True
+            cv2.resize(img, (FRAME_WIDTH, FRAME_HEIGHT), dst=buf, interpolation=cv2.INTER_AREA)
+            img = buf
+
+        put_latest(camera.capture_q, img, on_drop=camera.release_frame)
             
     cap.release()
 
-def generate_frames():
-    global frame
-    
-    while True:
-        if frame is None:
-            time.sleep(0.3)
+def collect_batch():
+    """Takes the newest frame from every camera that has one. Returns the
+    frames to run YOLO on, and the frames without visible change, which reuse
+    the previous detections."""
+    batch = []
+    unchanged = []
+    for camera in cameras:
+        try:
+            img = camera.capture_q.get_nowait()
+        except queue.Empty:
             continue
-            
-        with lock:
-            img = frame.copy()
-            
-        _, buffer = cv2.imencode('.jpg', img)
-        jpg_bytes = buffer.tobytes()
-        
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + jpg_bytes + b'\r\n')
 
-@app.route('/')
-def index():
-    return render_template_string(HTML_TEMPLATE)
+        small = cv2.resize(img, MOTION_SIZE, interpolation=cv2.INTER_AREA)
+        if camera.prev_small is not None and cv2.absdiff(small, camera.prev_small).mean() < MOTION_THRESHOLD:
+            unchanged.append((camera, img))
+            continue
+        camera.prev_small = small
+        batch.append((camera, img))
+    return batch, unchanged
+
+def run_inference():
+    """Stage 2: batches the newest frame from every camera through YOLO."""
+    # Raw uint8 frames are uploaded straight from their pinned frame buffers
+    # and preprocessed on the GPU. Two raw input tensors and CUDA streams let
+    # batch N+1 upload while batch N runs.
+    if USE_CUDA:
+        raw_shape = (BATCH_SIZE, FRAME_HEIGHT, FRAME_WIDTH, 3)
+        gpu_raw = [torch.empty(raw_shape, dtype=torch.uint8, device=DEVICE) for _ in range(2)]
+        streams = [torch.cuda.Stream(device=DEVICE) for _ in range(2)]
+
+    # On the GPU, torch.compile fuses the channel flip, transpose, scale and
+    # cast into a single pass over the frames. It is checked during warm-up
+    # and replaced by the eager function if it cannot compile on this host.
+    pre = torch.compile(preprocess) if USE_CUDA else preprocess
+
+    def upload(slot, batch):
+        if not USE_CUDA:
+            return batch, pre(torch.from_numpy(np.stack([img for _, img in batch]))), None
+
+        with torch.cuda.stream(streams[slot]):
+            raw = gpu_raw[slot][:len(batch)]
+            for i, (_, img) in enumerate(batch):
+                raw[i].copy_(torch.from_numpy(img), non_blocking=True)
+            gpu_in = pre(raw)
+            uploaded = torch.cuda.Event()
+            uploaded.record(streams[slot])
+        return batch, gpu_in, uploaded
+
+    def infer(batch, gpu_in, uploaded):
+        if uploaded is not None:
+            # The upload was queued an iteration ago and has normally finished.
+            # The engine runs outside torch's stream bookkeeping, so wait on
+            # the host rather than with stream.wait_event.
+            uploaded.synchronize()
+
+        preds = model(gpu_in)
+        results = non_max_suppression(preds, CONF_THRESHOLD, IOU_THRESHOLD)
+
+        for (camera, img), det in zip(batch, results):
+            current_detections, camera.overlay = extract_detections(det)
+            camera.detections_json = orjson.dumps(current_detections)
+            loop.call_soon_threadsafe(camera.notify_clients, 'detections')
+            camera.pass_to_encoder(img, camera.overlay)
+
+    # Run every batch size once before real frames arrive, so engine setup,
+    # preprocess compilation and cuDNN's algorithm search do not stall the
+    # first frames. NMS runs too, so a backend output it cannot handle fails
+    # here instead of on the first real batch.
+    print("Info: Warming up model...")
+    warmup_raw = torch.zeros((BATCH_SIZE, FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=torch.uint8, device=DEVICE)
+
+    def warm_up():
+        for n in range(1, BATCH_SIZE + 1):
+            preds = model(pre(warmup_raw[:n]))
+        return preds
+
+    try:
+        preds = warm_up()
+    except Exception as e:
+        # Inductor/Triton fail in many ways: GPUs below compute capability
+        # 7.0, no C compiler, some Jetson builds.
+        if pre is preprocess:
+            raise
+        print(f"Warning: torch.compile failed for preprocessing ({e}), running it eagerly.")
+        pre = preprocess
+        preds = warm_up()
+    non_max_suppression(preds, CONF_THRESHOLD, IOU_THRESHOLD)
+    print("Info: Model warm-up complete.")
+
+    # Each iteration queues the upload of the newest batch before running the
+    # previously uploaded one. Its raw GPU input slot is not reused until the
+    # batch after next, by which point infer() has synchronized it.
+    slot = 0
+    pending = None
+    while True:
+        batch, unchanged = collect_batch()
+        uploaded = None
+        if batch:
+            uploaded = upload(slot, batch)
+            slot ^= 1
+
+        if pending is not None:
+            infer(*pending)
+        # Only after the pending batch, which may hold the same camera's
+        # previous frame: the encoder gets each camera's frames in order, and
+        # these carry that frame's detections.
+        for camera, img in unchanged:
+            camera.pass_to_encoder(img, camera.overlay)
+        if pending is None and uploaded is None:
+            time.sleep(BATCH_INTERVAL)
+        pending = uploaded
+
+def extract_detections(det):
+    """Splits one image's NMS output rows (x1, y1, x2, y2, conf, cls) into the
+    detection dicts served as JSON and the integer boxes and labels to draw."""
+    # One bulk device-to-host copy; everything below is vectorized numpy.
+    boxes = det.cpu().numpy()
+    xyxy = boxes[:, :4]
+    conf = boxes[:, 4]
+    cls = boxes[:, 5].astype(int)
+    centers = (xyxy[:, :2] + xyxy[:, 2:]) * 0.5
+
+    class_names = [model.names[c] for c in cls.tolist()]
+    current_detections = [{
+        'bbox': bbox,
+        'confidence': confidence,
+        'class_id': class_id,
+        'class_name': class_name,
+        'center_x': center_x,
+        'center_y': center_y
+    } for bbox, confidence, class_id, class_name, (center_x, center_y)
+        in zip(xyxy.tolist(), conf.tolist(), cls.tolist(), class_names, centers.tolist())]
+
+    labels = [f"{class_name}: {confidence:.2f}" for class_name, confidence in zip(class_names, conf.tolist())]
+    return current_detections, (xyxy.astype(int), labels)
+
+def draw_overlay(img, xyxy, labels, font_scale=0.5, thickness=2):
+    for (x1, y1, x2, y2), label in zip(xyxy.tolist(), labels):
+        cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), thickness)
+        cv2.putText(img, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 255, 0), thickness)
+
+FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+
+def frame_part(jpg_bytes):
+    """Builds the multipart chunk for a JPEG and hashes it, once per frame for all clients."""
+    # Clients then compare integers, not bytes, and send the chunk in one write.
+    return FRAME_HEADER + jpg_bytes + b'\r\n', xxhash.xxh3_64_intdigest(jpg_bytes)
+
+def encode_frames(camera):
+    """Stage 3: draws the detections and JPEG-encodes one camera's frames for streaming."""
+    while True:
+        img, (xyxy, labels) = camera.infer_q.get()
+
+        if camera.waiters['small']:
+            cv2.resize(img, (PREVIEW_WIDTH, PREVIEW_HEIGHT), dst=camera.preview, interpolation=cv2.INTER_AREA)
+            draw_overlay(camera.preview, (xyxy * PREVIEW_SCALE).astype(int), labels, font_scale=0.4, thickness=1)
+            camera.latest_preview_jpeg = frame_part(encode_jpeg(camera.preview))
+
+        if camera.waiters['full'] or camera.waiters['webrtc']:
+            draw_overlay(img, xyxy, labels)
+        if camera.waiters['full']:
+            camera.latest_jpeg = frame_part(encode_jpeg(img))
+        if camera.waiters['webrtc']:
+            encoded = camera.h264.encode(img)
+            if encoded is not None:
+                loop.call_soon_threadsafe(camera.publish_h264, *encoded)
+
+        camera.release_frame(img)
 
-@app.route('/video_feed')
-def video_feed():
-    return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+        loop.call_soon_threadsafe(camera.notify_clients, 'full', 'small')
 
-@app.route('/detections')
-def get_detections():
-    with lock:
-        return json.dumps(detections)
+async def generate_frames(camera, res):
+    # Every client yields the same prebuilt multipart chunk as a single body
+    # message. The response is chunked, so uvicorn still copies it once per
+    # client when adding the chunk-size framing.
+    event = asyncio.Event()
+    camera.waiters[res].add(event)
+    last_hash = None
+    last_sent = 0.0
+    try:
+        while True:
+            await event.wait()
+            event.clear()
+            latest = camera.latest_preview_jpeg if res == 'small' else camera.latest_jpeg
+            if latest is None:
+                continue
+
+            # Only a byte-identical JPEG (a frozen or blank source) is
+            # skipped, and even then repeated to keep the connection alive.
+            part, jpg_hash = latest
+            now = time.monotonic()
+            if jpg_hash == last_hash and now - last_sent < JPEG_REFRESH_INTERVAL:
+                continue
+            last_hash = jpg_hash
+            last_sent = now
+
+            yield part
+    finally:
+        camera.waiters[res].discard(event)
+
+async def generate_detection_events(camera):
+    # Sends the current detections straight away, then one event each time
+    # inference produces new ones.
+    event = asyncio.Event()
+    camera.waiters['detections'].add(event)
+    try:
+        while True:
+            yield b'data: ' + camera.detections_json + b'\n\n'
+            await event.wait()
+            event.clear()
+    finally:
+        camera.waiters['detections'].discard(event)
+
+if USE_WEBRTC:
+    class CameraTrack(MediaStreamTrack):
+        """Hands a camera's shared H.264 packets to one WebRTC peer.
+
+        aiortc packetizes av.Packet objects as-is instead of re-encoding them,
+        so every peer gets the same encoded bytes.
+        """
+
+        kind = 'video'
+
+        def __init__(self, camera):
+            super().__init__()
+            self.camera = camera
+            self.packets = asyncio.Queue(maxsize=H264_PEER_QUEUE)
+            self.started = False
+            camera.waiters['webrtc'].add(self)
+            camera.h264.force_keyframe = True
+
+        def push(self, packet, is_keyframe):
+            # Decoding can only start at a keyframe, and every packet after it
+            # depends on the ones before.
+            if not self.started and not is_keyframe:
+                return
+            if self.packets.full():
+                # The peer fell behind; skip what it has not sent yet and
+                # resume at a fresh keyframe rather than sending a gap.
+                while not self.packets.empty():
+                    self.packets.get_nowait()
+                self.started = False
+                self.camera.h264.force_keyframe = True
+                return
+            self.started = True
+            self.packets.put_nowait(packet)
+
+        async def recv(self):
+            return await self.packets.get()
+
+        def stop(self):
+            super().stop()
+            self.camera.waiters['webrtc'].discard(self)
+
+peer_connections = set()
+
+def get_camera(request):
+    try:
+        source_id = int(request.query_params.get('source', 0))
+    except ValueError:
+        raise HTTPException(status_code=404)
+    if not 0 <= source_id < len(cameras):
+        raise HTTPException(status_code=404)
+    return cameras[source_id]
+
+index_template = Template(HTML_TEMPLATE)
+
+async def index(request):
+    return HTMLResponse(index_template.render(cameras=cameras, webrtc=USE_WEBRTC))
+
+async def video_feed(request):
+    res = request.query_params.get('res', 'full')
+    if res not in ('full', 'small'):
+        raise HTTPException(status_code=400)
+    return StreamingResponse(generate_frames(get_camera(request), res),
+                             media_type='multipart/x-mixed-replace; boundary=frame')
+
+async def offer(request):
+    camera = get_camera(request)
+    params = await request.json()
+
+    pc = RTCPeerConnection()
+    peer_connections.add(pc)
+    track = CameraTrack(camera)
+
+    @pc.on('connectionstatechange')
+    async def on_connectionstatechange():
+        if pc.connectionState in ('failed', 'closed'):
+            # The sender may never have started, so the track would otherwise
+            # stay registered and keep the encoder running.
+            track.stop()
+            await pc.close()
+            peer_connections.discard(pc)
+
+    try:
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=params['sdp'], type=params['type']))
+        pc.addTrack(track)
+        h264_codecs = [c for c in RTCRtpSender.getCapabilities('video').codecs if c.mimeType == 'video/H264']
+        for transceiver in pc.getTransceivers():
+            if transceiver.kind == 'video':
+                transceiver.setCodecPreferences(h264_codecs)
+
+        await pc.setLocalDescription(await pc.createAnswer())
+    except Exception:
+        # Closing fires the 'closed' state change above.
+        await pc.close()
+        raise
+    return JSONResponse({'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type})
+
+async def get_detections(request):
+    return Response(get_camera(request).detections_json, media_type='application/json')
+
+async def detections_stream(request):
+    return StreamingResponse(generate_detection_events(get_camera(request)),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global loop
+    loop = asyncio.get_running_loop()
+
+    for camera in cameras:
+        threading.Thread(target=capture_frames, args=(camera,), daemon=True).start()
+        threading.Thread(target=encode_frames, args=(camera,), daemon=True).start()
+    threading.Thread(target=run_inference, daemon=True).start()
+    yield
+
+    await asyncio.gather(*(pc.close() for pc in peer_connections))
+    peer_connections.clear()
+
+routes = [
+    Route('/', index),
+    Route('/video_feed', video_feed),
+    Route('/detections', get_detections),
+    Route('/detections/stream', detections_stream),
+]
+if USE_WEBRTC:
+    routes.append(Route('/offer', offer, methods=['POST']))
+
+app = Starlette(routes=routes, lifespan=lifespan)
 
 if __name__ == '__main__':
-    threading.Thread(target=capture_video, daemon=True).start()
-    
-    app.run(host='0.0.0.0', port=5001, debug=False)
\ No newline at end of file
+    # A single worker: the camera pipeline lives in this process. uvicorn
+    # picks uvloop automatically when it is installed.
+    uvicorn.run(app, host='0.0.0.0', port=5001, workers=1)
\ No newline at end of file
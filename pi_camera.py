@@ -17,8 +17,10 @@ QUALITY = 85
 app = Flask(__name__)
 picam2 = Picamera2()
 
+# Replaced with each new JPEG, never mutated, so readers need no lock.
 latest_frame_buffer = None
-frame_lock = threading.Lock()
+# Notified once per new JPEG so every client sends exactly one frame per capture.
+frame_ready = threading.Condition()
 
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
@@ -38,9 +40,10 @@ def capture_frames_continuously():
     global latest_frame_buffer
     print("Starting continuous frame capture thread...")
     try:
+        # Only the encoder consumes frames, so a single YUV420 stream is enough:
+        # it is the JPEG encoder's native input and needs no RGB->YCbCr pass.
         video_config = picam2.create_video_configuration(
-            main={"size": (FRAME_WIDTH, FRAME_HEIGHT), "format": "RGB888"},
-            lores={"size": (FRAME_WIDTH, FRAME_HEIGHT), "format": "YUV420"},
+            main={"size": (FRAME_WIDTH, FRAME_HEIGHT), "format": "YUV420"},
             controls={"FrameRate": FRAMERATE}
         )
         print("  Thread: Configuring camera...")
@@ -57,8 +60,9 @@ def capture_frames_continuously():
                 with output.condition:
                     output.condition.wait()
                     frame_data = output.frame
-                with frame_lock:
-                    latest_frame_buffer = frame_data
+                latest_frame_buffer = frame_data
+                with frame_ready:
+                    frame_ready.notify_all()
         except Exception as e:
             print(f"Error in capture loop: {e}")
         finally:
@@ -75,16 +79,12 @@ def generate_camera_stream():
     print("Client connected to camera stream.")
     try:
         while True:
-            with frame_lock:
-                frame_to_send = latest_frame_buffer
-
-            if frame_to_send is None:
-                time.sleep(0.01)
-                continue
+            with frame_ready:
+                frame_ready.wait()
+            frame_to_send = latest_frame_buffer
 
             yield (b'--frame\r\n'
                    b'Content-Type: image/jpeg\r\n\r\n' + frame_to_send + b'\r\n')
-            time.sleep(1/FRAMERATE * 0.8)
     except GeneratorExit:
         print("Client disconnected from camera stream.")
     except Exception as e: